@@ -4,7 +4,12 @@ import mimetypes
 import time
 import logging
 import openai
-from flask import Flask, request, jsonify, send_file, abort
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from flask import Flask, request, jsonify, send_file, abort, Response
+from flask.json.provider import JSONProvider
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import DefaultAzureCredential
 from azure.search.documents import SearchClient
 from approaches.retrievethenread import RetrieveThenReadApproach
@@ -21,6 +26,10 @@ AZURE_SEARCH_INDEX = os.environ.get("AZURE_SEARCH_INDEX") or "gptkbindex"
 AZURE_OPENAI_SERVICE = os.environ.get("AZURE_OPENAI_SERVICE") or "cog-sa6ggwlkxakec"
 AZURE_OPENAI_GPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT") or "davinci"
 AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT") or "chat"
+# Optional; when set, chat answers for semantically similar questions are served from an in-memory cache
+AZURE_OPENAI_EMB_DEPLOYMENT = os.environ.get("AZURE_OPENAI_EMB_DEPLOYMENT")
+# Optional; a small/cheap completion deployment used only to rewrite chat questions into search queries
+AZURE_OPENAI_QUERY_REWRITE_DEPLOYMENT = os.environ.get("AZURE_OPENAI_QUERY_REWRITE_DEPLOYMENT") or AZURE_OPENAI_GPT_DEPLOYMENT
 
 KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
@@ -42,11 +51,20 @@ openai.api_type = "azure_ad"
 openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
 openai.api_key = openai_token.token
 
+# Reuse pooled keep-alive connections for OpenAI and Cognitive Search instead of paying a
+# TLS handshake per call
+openai_session = requests.Session()
+openai_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+openai.requestssession = openai_session
+search_session = requests.Session()
+search_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
 # Set up clients for Cognitive Search and Storage
 search_client = SearchClient(
     endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
     index_name=AZURE_SEARCH_INDEX,
-    credential=azure_credential)
+    credential=azure_credential,
+    transport=RequestsTransport(session=search_session, session_owner=False))
 blob_client = BlobServiceClient(
     account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", 
     credential=azure_credential)
@@ -61,10 +79,19 @@ ask_approaches = {
 }
 
 chat_approaches = {
-    "rrr": ChatReadRetrieveReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
+    "rrr": ChatReadRetrieveReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT, query_rewrite_deployment=AZURE_OPENAI_QUERY_REWRITE_DEPLOYMENT)
 }
 
+# orjson is several times faster than the stdlib json encoder and serializes straight to bytes
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
@@ -113,7 +140,11 @@ def chat():
         impl = chat_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
+        overrides = request.json.get("overrides") or {}
+        r = impl.run(request.json["history"], overrides)
+        if overrides.get("stream"):
+            # Server-sent events: answer tokens as they arrive, then the full result
+            return Response((b"data: " + orjson.dumps(event) + b"\n\n" for event in r), mimetype="text/event-stream")
         return jsonify(r)
     except Exception as e:
         logging.exception("Exception in /chat")
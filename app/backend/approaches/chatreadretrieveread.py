@@ -1,11 +1,111 @@
-from typing import Any, Sequence
+import hashlib
+import io
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Sequence
 
+import cachetools
 import openai
+import orjson
 from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
 from approaches.approach import Approach
+from semanticcache import SemanticCache
 from text import nonewlines
 
+# Exact-match response cache, shared by all instances. Answers are only cached for
+# deterministic requests (temperature 0), so repeated questions skip the two OpenAI
+# calls and the search call entirely. TTLCache is not thread-safe, so all access
+# goes through the lock.
+response_cache = cachetools.TTLCache(maxsize=1024, ttl=3600)
+response_cache_lock = threading.Lock()
+
+# Used to overlap the speculative search call with the query-rewrite completion
+search_executor = ThreadPoolExecutor(max_workers=8)
+
+# Portuguese stopwords, used to decide whether a question is already keyword-like
+# enough to be used as the search query without an LLM rewrite
+STOPWORDS = frozenset([
+    "a", "o", "as", "os", "um", "uma", "uns", "umas", "de", "do", "da", "dos", "das",
+    "em", "no", "na", "nos", "nas", "por", "pelo", "pela", "pelos", "pelas", "para",
+    "com", "sem", "sob", "sobre", "ao", "aos", "à", "às", "e", "ou", "mas", "que",
+    "se", "não", "sim", "é", "são", "ser", "está", "estão", "foi", "era", "há", "ter",
+    "tem", "têm", "pode", "posso", "vou", "vai", "eu", "você", "ele", "ela", "eles",
+    "elas", "nós", "me", "meu", "minha", "meus", "minhas", "seu", "sua", "seus",
+    "suas", "este", "esta", "isto", "esse", "essa", "isso", "aquele", "aquela",
+    "aquilo", "como", "quando", "onde", "qual", "quais", "quem", "porque", "já",
+    "também", "muito", "mais", "menos", "depois", "antes", "entre", "até"])
+
+def is_keyword_like(question: str) -> bool:
+    tokens = re.findall(r"\w+", question.lower())
+    if not tokens or len(tokens) > 10:
+        return False
+    return sum(t in STOPWORDS for t in tokens) / len(tokens) < 0.5
+
+class SearchBatcher:
+    """
+    Coalesces concurrent search calls issued within a short window. Callers submit a key and a
+    fetch callable; requests arriving within the window are grouped by key, one fetch is issued
+    per unique key, and every waiter shares the result. Under bursty traffic N identical
+    searches collapse into one, which keeps the search service below its throttling limits.
+    """
+
+    def __init__(self, window: float = 0.01):
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}  # key -> (list of waiting futures, fetch callable)
+        self.wakeup = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=8)
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def submit(self, key, fetch) -> Future:
+        future = Future()
+        with self.lock:
+            if key in self.pending:
+                self.pending[key][0].append(future)
+            else:
+                self.pending[key] = ([future], fetch)
+                self.wakeup.set()
+        return future
+
+    def loop(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.window)  # let a burst accumulate before draining
+            with self.lock:
+                batch = self.pending
+                self.pending = {}
+                self.wakeup.clear()
+            for futures, fetch in batch.values():
+                self.executor.submit(self.dispatch, futures, fetch)
+
+    @staticmethod
+    def dispatch(futures, fetch):
+        try:
+            result = fetch()
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(result)
+
+search_batcher = SearchBatcher()
+
+# Fingerprint of the overrides that shape an answer, used to keep semantic-cache hits from
+# crossing filter/prompt boundaries; "stream" only changes delivery, not the answer content
+def overrides_fingerprint(overrides: dict) -> bytes:
+    return orjson.dumps({k: v for k, v in overrides.items() if k != "stream"}, option=orjson.OPT_SORT_KEYS)
+
+def token_jaccard(a: str, b: str) -> float:
+    tokens_a = set(re.findall(r"\w+", a.lower()))
+    tokens_b = set(re.findall(r"\w+", b.lower()))
+    if not tokens_a or not tokens_b:
+        return 0.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
 class ChatReadRetrieveReadApproach(Approach):
     """
     Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
@@ -46,94 +146,251 @@ Question:
 Search query:
 """
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, gpt_deployment: str, sourcepage_field: str, content_field: str):
+    # Split once at the placeholders so the per-request prompt is plain concatenation
+    # instead of re-parsing the template with str.format every turn
+    query_prompt_head, _rest = query_prompt_template.split("{chat_history}")
+    query_prompt_mid, query_prompt_tail = _rest.split("{question}")
+    del _rest
+
+    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, gpt_deployment: str, sourcepage_field: str, content_field: str, embedding_deployment: str = None, query_rewrite_deployment: str = None):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
         self.gpt_deployment = gpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        # Keyword extraction needs far less model than the answer does; point this at a small
+        # (e.g. -instruct) deployment to cut STEP-1 latency and cost
+        self.query_rewrite_deployment = query_rewrite_deployment or gpt_deployment
+        # Semantic cache over the last user question, only active when an embedding deployment is configured
+        self.semantic_cache = SemanticCache(embedding_deployment) if embedding_deployment else None
+        # Short-lived cache of search results per generated query, to keep repeated identical
+        # queries from hammering (and potentially throttling) the search service. The lock is
+        # needed because the speculative search runs in a worker thread alongside the request
+        # thread and TTLCache is not thread-safe.
+        self.search_cache = cachetools.TTLCache(maxsize=2048, ttl=300)
+        self.search_cache_lock = threading.Lock()
+        # The follow-up questions prompt only ever takes two values, so substitute it once up front
+        # and leave a shorter template to format on each request
+        self.prompt_prefix_without_followup = self.prompt_prefix.replace("{follow_up_questions_prompt}", "")
+        self.prompt_prefix_with_followup = self.prompt_prefix.replace("{follow_up_questions_prompt}", self.follow_up_questions_prompt_content)
 
     def run(self, history: Sequence[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        stream = True if overrides.get("stream") else False
+
+        # Only deterministic requests are safe to replay from the cache
+        cache_key = None
+        if overrides.get("temperature", 0.7) == 0:
+            cache_key = hashlib.sha256(orjson.dumps({"history": list(history), "overrides": overrides}, option=orjson.OPT_SORT_KEYS)).hexdigest()
+            with response_cache_lock:
+                cached = response_cache.get(cache_key)
+            if cached is not None:
+                return iter((cached,)) if stream else cached
+
+        # Paraphrased repeats of earlier questions can be answered straight from the semantic
+        # cache, but only for answers generated under the same overrides
+        question_vector = None
+        if self.semantic_cache:
+            question_vector = self.semantic_cache.embed(history[-1]["user"])
+            cached = self.semantic_cache.get(question_vector, overrides_fingerprint(overrides))
+            if cached is not None:
+                return iter((cached,)) if stream else cached
+
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        prompt = self.query_prompt_template.format(chat_history=self.get_chat_history_as_text(history, include_last_turn=False), question=history[-1]["user"])
-        completion = openai.Completion.create(
-            engine=self.gpt_deployment, 
-            prompt=prompt, 
-            temperature=0.0, 
-            max_tokens=32, 
-            n=1, 
-            stop=["\n"])
-        q = completion.choices[0].text
+        filter = "category ne '" + exclude_category.replace("'", "''") + "'" if exclude_category else None
 
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
+        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question.
+        # The rewritten query usually resembles the raw question, so speculatively search on the raw question
+        # in parallel with the completion and keep that result if the rewrite turns out close enough.
+        question = history[-1]["user"]
+        speculative_search = search_executor.submit(self.search, question, overrides, filter, top, use_semantic_captions)
+        chat_history, chat_history_without_last_turn = self.get_chat_history_as_texts(history)
+        if is_keyword_like(question):
+            # Short, content-word-heavy questions are already good keyword queries; skip the rewrite completion
+            q = question
         else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            prompt = self.query_prompt_head + chat_history_without_last_turn + self.query_prompt_mid + question + self.query_prompt_tail
+            completion = openai.Completion.create(
+                engine=self.query_rewrite_deployment,
+                prompt=prompt,
+                temperature=0.0,
+                max_tokens=32,
+                n=1,
+                stop=["\n"])
+            q = completion.choices[0].text
+
+        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        if token_jaccard(q, question) > 0.6:
+            docs = speculative_search.result()
         else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
-        content = "\n".join(results)
+            speculative_search.cancel()
+            docs = self.search(q, overrides, filter, top, use_semantic_captions)
+        # Build the sources text alongside the results list in a single pass over the documents
+        buffer = io.StringIO()
+        results = []
+        for doc in docs:
+            if use_semantic_captions:
+                line = doc[self.sourcepage_field] + ": " + nonewlines(" . ".join(c.text for c in doc['@search.captions']))
+            else:
+                line = doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
+            if results:
+                buffer.write("\n")
+            results.append(line)
+            buffer.write(line)
+        content = buffer.getvalue()
+
+        prompt_prefix = self.prompt_prefix_with_followup if overrides.get("suggest_followup_questions") else self.prompt_prefix_without_followup
 
-        follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
-        
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         prompt_override = overrides.get("prompt_template")
         if prompt_override is None:
-            prompt = self.prompt_prefix.format(injected_prompt="", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
+            prompt = prompt_prefix.format(injected_prompt="", sources=content, chat_history=chat_history)
         elif prompt_override.startswith(">>>"):
-            prompt = self.prompt_prefix.format(injected_prompt=prompt_override[3:] + "\n", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
+            prompt = prompt_prefix.format(injected_prompt=prompt_override[3:] + "\n", sources=content, chat_history=chat_history)
         else:
-            prompt = prompt_override.format(sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
+            follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
+            prompt = prompt_override.format(sources=content, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
 
         messages = self.get_messages_from_prompt(prompt)
 
-        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
+        # STEP 3: Generate a contextual and content specific answer using the search results and chat history.
+        # When streaming is requested, hand back a generator so the caller can forward tokens as they arrive
+        # instead of waiting for the full answer.
+        if stream:
+            return self.stream_response(messages, overrides, results, q, prompt, cache_key, question_vector)
+
+        # "or 0.7" would coerce an explicit temperature of 0 back to 0.7, so test for None
+        temperature = overrides.get("temperature")
         chatCompletion = openai.ChatCompletion.create(
             deployment_id=self.chatgpt_deployment,
             model="gpt-3.5-turbo",
-            messages=messages, 
-            temperature=overrides.get("temperature") or 0.7, 
-            max_tokens=1024, 
-            n=1, 
+            messages=messages,
+            temperature=0.7 if temperature is None else temperature,
+            max_tokens=1024,
+            n=1,
             stop=["<|im_end|>", "<|im_start|>"])
         
         chatContent = chatCompletion.choices[0].message.content
 
-        return {"data_points": results, "answer": chatContent, "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+        result = {"data_points": results, "answer": chatContent, "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+        if cache_key is not None:
+            with response_cache_lock:
+                response_cache[cache_key] = result
+        if question_vector is not None:
+            self.semantic_cache.put(question_vector, overrides_fingerprint(overrides), result)
+        return result
+
+    # Yields {"answer_delta": token} events as the completion streams in, then the same final
+    # result dict run() would have returned so data_points/thoughts still reach the client
+    def stream_response(self, messages, overrides, results, q, prompt, cache_key, question_vector):
+        # "or 0.7" would coerce an explicit temperature of 0 back to 0.7, so test for None
+        temperature = overrides.get("temperature")
+        deltas = []
+        for chunk in openai.ChatCompletion.create(
+                deployment_id=self.chatgpt_deployment,
+                model="gpt-3.5-turbo",
+                messages=messages,
+                temperature=0.7 if temperature is None else temperature,
+                max_tokens=1024,
+                n=1,
+                stop=["<|im_end|>", "<|im_start|>"],
+                stream=True):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.get("content")
+            if delta:
+                deltas.append(delta)
+                yield {"answer_delta": delta}
+
+        result = {"data_points": results, "answer": "".join(deltas), "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+        if cache_key is not None:
+            with response_cache_lock:
+                response_cache[cache_key] = result
+        if question_vector is not None:
+            self.semantic_cache.put(question_vector, overrides_fingerprint(overrides), result)
+        yield result
     
+    # Set to False to bypass the search result cache (e.g. when experimenting with index changes)
+    search_cache_enabled = True
+
+    def search(self, q: str, overrides: dict[str, Any], filter: str, top: int, use_semantic_captions: bool) -> List[Any]:
+        key = (q, filter, top, bool(overrides.get("semantic_ranker")), use_semantic_captions)
+        if self.search_cache_enabled:
+            with self.search_cache_lock:
+                cached = self.search_cache.get(key)
+            if cached is not None:
+                return cached
+        # Coalesce with any identical search already in flight or arriving within the batching window
+        docs = search_batcher.submit(key, lambda: self.search_index(q, overrides, filter, top, use_semantic_captions)).result()
+        if self.search_cache_enabled:
+            with self.search_cache_lock:
+                self.search_cache[key] = docs
+        return docs
+
+    def search_index(self, q: str, overrides: dict[str, Any], filter: str, top: int, use_semantic_captions: bool) -> List[Any]:
+        # Drain the paged iterator in one go; the response is already batched server-side,
+        # and iterating lazily can block on a network read per page
+        if overrides.get("semantic_ranker"):
+            docs = list(self.search_client.search(q,
+                                                  filter=filter,
+                                                  query_type=QueryType.SEMANTIC,
+                                                  query_language="en-us",
+                                                  query_speller="lexicon",
+                                                  semantic_configuration_name="default",
+                                                  top=top,
+                                                  query_caption="extractive|highlight-false" if use_semantic_captions else None))
+        else:
+            docs = list(self.search_client.search(q, filter=filter, top=top))
+        return docs
+
     def get_chat_history_as_text(self, history: Sequence[dict[str, str]], include_last_turn: bool=True, approx_max_tokens: int=1000) -> str:
-        history_text = ""
+        # Collect the most recent turns that fit, then join once - prepending to a string in the loop is O(n^2)
+        parts = []
+        total_length = 0
         for h in reversed(history if include_last_turn else history[:-1]):
-            history_text = """<|im_start|>user""" + "\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot", "") + """<|im_end|>""" if h.get("bot") else "") + "\n" + history_text
-            if len(history_text) > approx_max_tokens*4:
-                break    
-        return history_text
-    
-    # Generate messages needed for chat Completion api
-    from typing import List
+            bot = h.get("bot")
+            part = "<|im_start|>user" + "\n" + h["user"] + "\n" + "<|im_end|>" + "\n" + "<|im_start|>assistant" + "\n" + (bot + "<|im_end|>" if bot else "") + "\n"
+            parts.append(part)
+            total_length += len(part)
+            if total_length > approx_max_tokens*4:
+                break
+        return "".join(reversed(parts))
+
+    # Build the with-last-turn and without-last-turn history texts from a single traversal,
+    # applying the same most-recent-turns-first budget to each variant
+    def get_chat_history_as_texts(self, history: Sequence[dict[str, str]], approx_max_tokens: int=1000) -> tuple:
+        limit = approx_max_tokens*4
+        parts = []  # most recent turn first
+        total_length = 0
+        for h in reversed(history):
+            bot = h.get("bot")
+            part = "<|im_start|>user" + "\n" + h["user"] + "\n" + "<|im_end|>" + "\n" + "<|im_start|>assistant" + "\n" + (bot + "<|im_end|>" if bot else "") + "\n"
+            parts.append(part)
+            total_length += len(part)
+            # the without-last variant skips parts[0], so it is the last one to fill up
+            if total_length - len(parts[0]) > limit:
+                break
+        return self.join_turns(parts, limit), self.join_turns(parts[1:], limit)
 
+    @staticmethod
+    def join_turns(parts: List[str], limit: int) -> str:
+        included = []
+        total_length = 0
+        for part in parts:
+            included.append(part)
+            total_length += len(part)
+            if total_length > limit:
+                break
+        return "".join(reversed(included))
+    
+    # Generate messages needed for chat Completion api, one message per <|im_start|>...<|im_end|> block
     def get_messages_from_prompt(self, prompt: str) -> List[dict[str, str]]:
         messages = []
-        for line in prompt.splitlines():
-            if line.startswith("<|im_start|>"):
-                index = "<|im_start|>".__len__()
-                role = line[index:]
-            elif line.startswith("<|im_end|>"):
+        for section in prompt.split("<|im_start|>"):
+            if not section:
                 continue
-            else:
-                messages.append({"role": role, "content": line})
+            role, _, body = section.partition("\n")
+            content = body.split("<|im_end|>", 1)[0].rstrip("\n")
+            messages.append({"role": role.strip(), "content": content})
         return messages
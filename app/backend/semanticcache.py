@@ -0,0 +1,51 @@
+import threading
+
+import numpy as np
+import openai
+
+
+class SemanticCache:
+    """
+    In-memory semantic cache over question embeddings. Questions are embedded with an Azure OpenAI
+    embedding deployment and matched against previously answered questions by cosine similarity, so
+    paraphrased repeats ("Como reseto senha?" vs "Como troco senha?") can reuse a stored answer
+    without any further OpenAI or search calls. Each entry carries a caller-supplied fingerprint
+    (e.g. of the request overrides) and only entries with an equal fingerprint are eligible hits,
+    so answers generated under different filters or prompts are never mixed up.
+    """
+
+    def __init__(self, embedding_deployment: str, similarity_threshold: float = 0.92, maxsize: int = 1024):
+        self.embedding_deployment = embedding_deployment
+        self.similarity_threshold = similarity_threshold
+        self.maxsize = maxsize
+        self.vectors = np.empty((0, 0), dtype=np.float32)  # (n, d), L2-normalized rows
+        self.entries = []  # parallel list of (fingerprint, value)
+        self.lock = threading.Lock()
+
+    def embed(self, text: str) -> np.ndarray:
+        embedding = openai.Embedding.create(engine=self.embedding_deployment, input=text)["data"][0]["embedding"]
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, vector: np.ndarray, fingerprint):
+        with self.lock:
+            candidates = [i for i, (entry_fingerprint, _) in enumerate(self.entries) if entry_fingerprint == fingerprint]
+            if not candidates:
+                return None
+            similarities = self.vectors[candidates] @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                return self.entries[candidates[best]][1]
+            return None
+
+    def put(self, vector: np.ndarray, fingerprint, value) -> None:
+        with self.lock:
+            if not self.entries:
+                self.vectors = vector.reshape(1, -1)
+            else:
+                self.vectors = np.vstack((self.vectors, vector))
+            self.entries.append((fingerprint, value))
+            if len(self.entries) > self.maxsize:
+                self.vectors = self.vectors[1:]
+                del self.entries[0]
@@ -1,2 +1,6 @@
+import re
+
+_NEWLINES = re.compile(r"[\r\n]+")
+
 def nonewlines(s: str) -> str:
-    return s.replace('\n', ' ').replace('\r', ' ')
+    return _NEWLINES.sub(' ', s)